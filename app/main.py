@@ -1,14 +1,19 @@
 # app/main.py
 # Main FastAPI application for TTS and STT
 
-from fastapi import FastAPI, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
-import io
+from fastapi import FastAPI, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from pydantic import BaseModel, Field
+import asyncio
+import fcntl
 import logging
+import os
 
 # Import TTS and STT processing functions
-from .tts_module import synthesize_speech_to_bytes, tts_model
-from .stt_module import transcribe_audio_file, stt_model
+# The models are loaded at startup, so they are read from their modules rather than imported by value
+from . import tts_module, stt_module
+from .tts_module import synth_stream, get_tts_model, warmup_tts, get_tts_cache_stats, TTS_POOL
+from .stt_module import transcribe_audio_file, get_stt_model, warmup_stt, batch_worker, LocalAgreementTranscriber, STT_POOL, device as stt_device
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -16,49 +21,93 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="TTS/STT API",
-    description="A REST API for Text-to-Speech and Speech-to-Text using Coqui TTS and OpenAI Whisper.",
-    version="0.1.0"
+    description="A REST API for Text-to-Speech and Speech-to-Text using Coqui TTS and faster-whisper.",
+    version="0.1.0",
+    # JSON responses are serialized with orjson instead of the stdlib json module
+    default_response_class=ORJSONResponse
 )
 
+class TTSRequest(BaseModel):
+    """
+    Body of a /tts/ request.
+    """
+    text: str = Field(..., min_length=1, max_length=2000, description="Text to synthesize.")
+
+# Lock file serializing model downloads across worker processes
+MODEL_LOCK_PATH = "/app/models/.lock"
+
+def _load_models():
+    """
+    Loads both models while holding an exclusive lock on MODEL_LOCK_PATH.
+    Concurrent workers wait for the first one to finish downloading and then reuse its files
+    instead of downloading again into a partially populated directory.
+    """
+    try:
+        os.makedirs(os.path.dirname(MODEL_LOCK_PATH), exist_ok=True)
+        lock_file = open(MODEL_LOCK_PATH, "w")
+    except OSError as e:
+        logger.warning(f"Could not open model lock {MODEL_LOCK_PATH}, loading models without it: {e}")
+        get_tts_model()
+        get_stt_model()
+        return
+
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        logger.info(f"Acquired model lock {MODEL_LOCK_PATH}.")
+        get_tts_model()
+        get_stt_model()
+
 @app.on_event("startup")
 async def startup_event():
-    logger.info("Application startup...")
-    if tts_model is None:
+    logger.info(f"Application startup (pid {os.getpid()})...")
+    web_workers = int(os.getenv("WEB_WORKERS", "2"))
+    if stt_device == "cuda" and web_workers > 1:
+        logger.warning(f"WEB_WORKERS={web_workers} with CUDA: every worker creates its own CUDA context "
+                       "and loads its own copy of the models. Use a single worker per GPU.")
+    # Loading runs in a thread so that the event loop stays responsive. UvicornWorker only starts
+    # notifying the Gunicorn arbiter once startup has finished, so loading and warm-up are bounded
+    # by WEB_TIMEOUT (gunicorn.conf.py), not kept alive by a heartbeat.
+    await asyncio.get_running_loop().run_in_executor(None, _load_models)
+    if tts_module.tts_model is None:
         logger.error("TTS model failed to load. TTS endpoint will not be available.")
-    if stt_model is None:
+    else:
+        await warmup_tts()
+    if stt_module.stt_model is None:
         logger.error("STT model failed to load. STT endpoint will not be available.")
+    else:
+        await warmup_stt()
+        # Keep a reference to the task so that it is not garbage collected
+        app.state.stt_worker = asyncio.create_task(batch_worker())
     logger.info("Application startup complete.")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    stt_worker = getattr(app.state, "stt_worker", None)
+    if stt_worker is not None:
+        stt_worker.cancel()
+    TTS_POOL.shutdown(wait=False, cancel_futures=True)
+    STT_POOL.shutdown(wait=False, cancel_futures=True)
+
 @app.post("/tts/",
           summary="Text-to-Speech",
           description="Converts input text to speech (WAV audio format).",
           tags=["TTS"])
-async def text_to_speech(payload: dict):
+async def text_to_speech(payload: TTSRequest):
     """
     Converts text to speech.
-    Input: JSON payload with a "text" field.
-    Output: WAV audio stream.
+    Input: JSON payload with a "text" field (1 to 2000 characters, validated by TTSRequest).
+    Output: WAV audio stream (16-bit PCM, streamed sentence by sentence).
     """
-    if tts_model is None:
+    if tts_module.tts_model is None:
         logger.error("TTS request failed: TTS model not loaded.")
         raise HTTPException(status_code=503, detail="TTS service is unavailable due to model loading issues.")
 
-    text = payload.get("text")
-    if not text:
-        logger.warning("TTS request failed: 'text' field is missing or empty.")
-        raise HTTPException(status_code=400, detail="'text' field is required in the JSON payload.")
-
-    try:
-        logger.info(f"Received TTS request for text: \"{text[:50]}...\"")
-        audio_bytes = synthesize_speech_to_bytes(text)
-        logger.info("Speech synthesized successfully.")
-        return StreamingResponse(io.BytesIO(audio_bytes), media_type="audio/wav")
-    except RuntimeError as e:
-        logger.error(f"TTS Runtime Error: {e}")
-        raise HTTPException(status_code=500, detail=f"TTS synthesis failed: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error during TTS: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"An unexpected error occurred during TTS: {e}")
+    text = payload.text
+    logger.info(f"Received TTS request for text: \"{text[:50]}...\"")
+    # Audio is synthesized sentence by sentence while the response is being sent,
+    # so errors during synthesis end the stream instead of returning a 500.
+    # Each sentence is synthesized in the TTS thread pool, keeping the event loop responsive.
+    return StreamingResponse(synth_stream(text), media_type="audio/wav")
 
 @app.post("/stt/",
           summary="Speech-to-Text",
@@ -70,7 +119,7 @@ async def speech_to_text(audio_file: UploadFile = File(..., description="Audio f
     Input: Audio file (e.g., WAV, MP3).
     Output: JSON with "transcription" field.
     """
-    if stt_model is None:
+    if stt_module.stt_model is None:
         logger.error("STT request failed: STT model not loaded.")
         raise HTTPException(status_code=503, detail="STT service is unavailable due to model loading issues.")
 
@@ -98,9 +147,63 @@ async def speech_to_text(audio_file: UploadFile = File(..., description="Audio f
         logger.error(f"Unexpected error during STT: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred during STT: {e}")
 
+@app.websocket("/stt/stream")
+async def speech_to_text_stream(websocket: WebSocket):
+    """
+    Transcribes live audio incrementally.
+    Input: binary messages with 16 kHz mono 16-bit little-endian PCM; a text message "end" finishes the stream.
+    Output: JSON messages {"text": ..., "final": false} with newly confirmed text, then one with "final": true.
+    """
+    await websocket.accept()
+    if stt_module.stt_model is None:
+        logger.error("STT stream failed: STT model not loaded.")
+        await websocket.close(code=1011, reason="STT service is unavailable due to model loading issues.")
+        return
+
+    logger.info("STT stream opened.")
+    transcriber = LocalAgreementTranscriber()
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                logger.info("STT stream closed by the client.")
+                return
+            if message.get("bytes"):
+                transcriber.insert_audio(message["bytes"])
+                if transcriber.ready():
+                    text = await transcriber.process()
+                    if text:
+                        await websocket.send_json({"text": text, "final": False})
+            elif message.get("text") == "end":
+                text = await transcriber.finish()
+                await websocket.send_json({"text": text, "final": True})
+                await websocket.close()
+                logger.info("STT stream finished.")
+                return
+    except WebSocketDisconnect:
+        logger.info("STT stream closed by the client.")
+    except Exception as e:
+        logger.error(f"Unexpected error during STT stream: {e}", exc_info=True)
+        await websocket.close(code=1011, reason="STT transcription failed.")
+
+@app.get("/metrics",
+         summary="Metrics",
+         description="Returns the counters of the worker process that answers, such as TTS cache hits and size.",
+         tags=["Metrics"])
+async def metrics():
+    """
+    Returns service metrics.
+    Output: JSON with the "pid" of the answering worker and its "tts_cache" object.
+    Counters are per worker process: with several workers, each scrape may be answered by a different one.
+    """
+    return {"pid": os.getpid(), "tts_cache": get_tts_cache_stats()}
+
 if __name__ == "__main__":
     import uvicorn
     # This is for local debugging of the main.py file itself, not for Docker.
     # Docker will use the CMD instruction.
     logger.info("Starting Uvicorn server for local debugging...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop and httptools come with uvicorn[standard]; workers > 1 requires the app as an import string.
+    # Run as `python -m app.main` from the repository root.
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools",
+                workers=int(os.getenv("WEB_WORKERS", "2")))
\ No newline at end of file
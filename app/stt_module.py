@@ -1,37 +1,554 @@
 # app/stt_module.py
-# Module for Speech-to-Text using OpenAI Whisper
+# Module for Speech-to-Text using faster-whisper (CTranslate2 backend)
 
-import whisper
-import tempfile
+from faster_whisper import WhisperModel, BatchedInferencePipeline, decode_audio
+from faster_whisper.feature_extractor import FeatureExtractor
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.transcribe import get_compression_ratio
+from faster_whisper.vad import VadOptions, get_speech_timestamps, merge_segments
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
 import os
-import shutil
+import string
+import time
+from typing import BinaryIO
 from fastapi import UploadFile
+import numpy as np
+import soundfile as sf
 import torch
 import logging
 
 logger = logging.getLogger(__name__)
 
 # Determine device
+# With several GPUs, STT runs on the second one so that it does not compete with TTS (on cuda:0).
 device = "cuda" if torch.cuda.is_available() else "cpu"
-logger.info(f"STT module will use device: {device}")
+device_index = 1 if device == "cuda" and torch.cuda.device_count() > 1 else 0
+logger.info(f"STT module will use device: {device}" + (f":{device_index}" if device == "cuda" else ""))
 
-# Load Whisper model
+# Load Whisper model (CTranslate2 conversion from the Hugging Face Hub)
 # This will download the model on first run to the specified download_root if not already present.
-# The Dockerfile aims to pre-download this.
+# The Dockerfile aims to pre-download this. Loading happens in get_stt_model(), called at application startup.
 stt_model_name = "base.en"  # Options: "tiny.en", "base.en", "small.en", "medium.en", "large.en"
 # Model directory should match the one used in Dockerfile for pre-downloading
 model_dir = "/app/models/whisper" 
 stt_model = None
+batched_model = None
+# CTranslate2 compute type, resolved by get_stt_model()
+compute_type = None
+# Tokenizer and decoder prompt used by the short-clip path, set when the model is loaded
+_stt_tokenizer = None
+_stt_prompt = None
 
-try:
-    logger.info(f"Loading Whisper STT model: {stt_model_name} from {model_dir}...")
-    # Ensure the directory exists for loading, though Dockerfile should create it
-    os.makedirs(model_dir, exist_ok=True) 
-    stt_model = whisper.load_model(stt_model_name, download_root=model_dir, device=device)
-    logger.info(f"Whisper STT model '{stt_model_name}' loaded successfully on {device}.")
-except Exception as e:
-    logger.error(f"Error loading Whisper STT model '{stt_model_name}': {e}", exc_info=True)
-    stt_model = None # Ensure model is None if loading fails
+# Whisper log-Mel feature settings (25 ms window, 10 ms hop at 16 kHz)
+N_FFT = 400
+HOP_LENGTH = 160
+# GPU copies of the Mel filterbank and STFT window, set when the model is loaded on CUDA
+_mel_filters = None
+_hann = None
+# High-priority CUDA stream for the STT torch work (feature extraction), created at load time.
+# CTranslate2 runs the model itself on its own streams.
+STT_STREAM = None
+
+
+def _stt_stream_context():
+    """
+    Returns a context manager running CUDA work on STT_STREAM (a no-op on CPU).
+    """
+    return torch.cuda.stream(STT_STREAM) if STT_STREAM is not None else contextlib.nullcontext()
+
+
+def batched_log_mel(audio_batch: torch.Tensor, padding: int = HOP_LENGTH) -> torch.Tensor:
+    """
+    Computes Whisper log-Mel spectrograms for a (batch, samples) waveform tensor in a single
+    batched STFT + filterbank matmul on the GPU. Output matches faster-whisper's FeatureExtractor.
+    """
+    if padding:
+        audio_batch = torch.nn.functional.pad(audio_batch, (0, padding))
+    stft = torch.stft(audio_batch, N_FFT, HOP_LENGTH, window=_hann, return_complex=True)
+    magnitudes = stft[..., :-1].abs() ** 2
+    mel_spec = _mel_filters @ magnitudes
+    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+    # Dynamic range compression is applied per item, not across the batch
+    log_spec = torch.maximum(log_spec, log_spec.amax(dim=(-2, -1), keepdim=True) - 8.0)
+    return (log_spec + 4.0) / 4.0
+
+
+class GpuFeatureExtractor(FeatureExtractor):
+    """
+    Drop-in replacement for faster-whisper's NumPy FeatureExtractor that runs on the GPU.
+    """
+
+    def __call__(self, waveform, padding=HOP_LENGTH, chunk_length=None):
+        if chunk_length is not None:
+            self.n_samples = chunk_length * self.sampling_rate
+            self.nb_max_frames = self.n_samples // self.hop_length
+        with _stt_stream_context():
+            audio = torch.as_tensor(waveform, dtype=torch.float32).to(_hann.device)
+            # CTranslate2 takes host arrays, so the features are copied back once per call
+            return batched_log_mel(audio.unsqueeze(0), padding)[0].cpu().numpy()
+
+
+def _select_compute_type() -> str:
+    """
+    Returns the CTranslate2 compute_type for the current device.
+    """
+    # Weights are int8 everywhere; on GPUs with Tensor Cores the activations run in half precision:
+    # bfloat16 on Ampere and newer (compute capability >= 8.0), float16 on Volta/Turing (>= 7.0).
+    # Older GPUs and the CPU path run plain int8 with float32 activations.
+    if device != "cuda":
+        return "int8"
+    cuda_major_capability = torch.cuda.get_device_capability(device_index)[0]
+    selected_compute_type = "int8"
+    if cuda_major_capability >= 8:
+        selected_compute_type = "int8_bfloat16"
+    elif cuda_major_capability >= 7:
+        selected_compute_type = "int8_float16"
+
+    return selected_compute_type
+
+
+def _verify_model_cache(cache_dir: str):
+    """
+    Checks the downloaded model files against their SHA-256 digests.
+    The Hugging Face cache stores large (LFS) files as blobs named after their SHA-256, so a blob
+    whose content does not match its name is partial or corrupt. It is removed so that the loader
+    downloads it again instead of failing on (or silently using) a broken file.
+    Each blob is hashed only once: a marker file records the size and modification time of verified
+    blobs, so later starts (and workers waiting on the model lock) skip the hashing.
+    """
+    for repo_dir in os.listdir(cache_dir):
+        blobs_dir = os.path.join(cache_dir, repo_dir, "blobs")
+        if not os.path.isdir(blobs_dir):
+            continue
+        for blob_name in os.listdir(blobs_dir):
+            # Only LFS blobs are named by SHA-256 (64 hex digits); small files use git SHA-1 names
+            if len(blob_name) != 64 or any(c not in string.hexdigits for c in blob_name):
+                continue
+            blob_path = os.path.join(blobs_dir, blob_name)
+            marker_path = os.path.join(blobs_dir, f".{blob_name}.verified")
+            blob_stat = os.stat(blob_path)
+            stamp = f"{blob_stat.st_size}:{blob_stat.st_mtime_ns}"
+            try:
+                with open(marker_path) as marker_file:
+                    if marker_file.read() == stamp:
+                        continue
+            except OSError:
+                pass # Not verified yet
+
+            digest = hashlib.sha256()
+            with open(blob_path, "rb") as blob_file:
+                for block in iter(lambda: blob_file.read(1 << 20), b""):
+                    digest.update(block)
+            if digest.hexdigest() != blob_name:
+                logger.warning(f"Model file {blob_path} failed SHA-256 verification, removing it to re-download.")
+                os.remove(blob_path)
+                continue
+            try:
+                with open(marker_path, "w") as marker_file:
+                    marker_file.write(stamp)
+            except OSError as e:
+                logger.debug(f"Could not record the verification of {blob_path}: {e}")
+
+
+def get_stt_model():
+    """
+    Returns the Whisper model, loading it and its helpers into the module globals on first use.
+    Returns None if loading failed. Must run in the worker process: CTranslate2's worker
+    threads and CUDA contexts do not survive fork().
+    Callers running several processes should hold the model directory lock (see main.py).
+    """
+    global stt_model, batched_model, compute_type
+    global _stt_tokenizer, _stt_prompt, _mel_filters, _hann, STT_STREAM
+    if stt_model is not None:
+        return stt_model
+
+    try:
+        compute_type = _select_compute_type()
+        logger.info(f"Loading Whisper STT model: {stt_model_name} from {model_dir} ({compute_type})...")
+        # Ensure the directory exists for loading, though Dockerfile should create it
+        os.makedirs(model_dir, exist_ok=True) 
+        _verify_model_cache(model_dir)
+        model = WhisperModel(stt_model_name, device=device, device_index=device_index, compute_type=compute_type,
+                             download_root=model_dir)
+        if device == "cuda":
+            # Compute log-Mel features on the GPU instead of with NumPy on the CPU
+            torch_device = torch.device("cuda", device_index)
+            _mel_filters = torch.from_numpy(model.feature_extractor.mel_filters).float().to(torch_device)
+            _hann = torch.hann_window(N_FFT, device=torch_device)
+            STT_STREAM = torch.cuda.Stream(device=torch_device, priority=-1)
+            # The filterbank and window were created on the default stream
+            torch.cuda.synchronize(torch_device)
+            model.feature_extractor = GpuFeatureExtractor(**model.feat_kwargs)
+        # The batched pipeline decodes the 30 s chunks of an audio in parallel instead of one after another
+        batched_model = BatchedInferencePipeline(model=model)
+        _stt_tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language="en")
+        _stt_prompt = model.get_prompt(_stt_tokenizer, previous_tokens=[], without_timestamps=True)
+        # Published last so that the model is never visible half-initialized
+        stt_model = model
+        logger.info(f"Whisper STT model '{stt_model_name}' loaded successfully on {device} ({compute_type}).")
+    except Exception as e:
+        logger.error(f"Error loading Whisper STT model '{stt_model_name}': {e}", exc_info=True)
+        stt_model = None # Ensure model is None if loading fails
+        batched_model = None
+    return stt_model
+
+# Micro-batching settings
+STT_SAMPLE_RATE = 16000  # Whisper expects 16 kHz mono audio
+STT_MAX_BATCH = 16       # Max number of requests (and 30 s chunks) handled per batch
+STT_MAX_WAIT_MS = 20     # How long the worker waits for more requests after the first one
+
+# Clips up to one Whisper window long are encoded and decoded together in a single pass
+STT_CHUNK_SAMPLES = 30 * STT_SAMPLE_RATE
+STT_CHUNK_FRAMES = STT_CHUNK_SAMPLES // HOP_LENGTH
+# Same thresholds as faster-whisper's defaults
+STT_NO_SPEECH_THRESHOLD = 0.6
+STT_LOG_PROB_THRESHOLD = -1.0
+STT_COMPRESSION_RATIO_THRESHOLD = 2.4
+# Temperatures tried in turn when a short clip fails those checks: faster-whisper's defaults,
+# without 0.0 since the greedy pass of the short-clip path already ran at that temperature
+STT_FALLBACK_TEMPERATURES = [0.2, 0.4, 0.6, 0.8, 1.0]
+# Silero VAD (bundled with faster-whisper) settings used to trim silence before the encoder.
+# Same settings as the batched pipeline's own VAD, so that its 30 s chunks can be built from
+# the speech timestamps already computed instead of running the VAD a second time.
+STT_VAD_OPTIONS = VadOptions(max_speech_duration_s=STT_CHUNK_SAMPLES // STT_SAMPLE_RATE, min_silence_duration_ms=160)
+
+# Decoding and transcription run here instead of on the event loop.
+# A single worker serializes access to the model (and the GPU).
+STT_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="stt")
+
+# Pending STT requests as (uploaded audio file object, future) pairs.
+# Filled by transcribe_audio_file() and drained by batch_worker().
+stt_queue: asyncio.Queue = asyncio.Queue()
+
+
+def _decode_audio_file(audio_file: BinaryIO) -> np.ndarray:
+    """
+    Decodes an encoded audio file object to a float32 mono waveform at STT_SAMPLE_RATE.
+    The file is read in place, without copying its whole content into a bytes object first.
+    """
+    # Fast path: formats handled by libsndfile (WAV, FLAC, OGG) that are already at 16 kHz.
+    # Only the header is read to check the sample rate, so other files are decoded once, by PyAV.
+    audio_file.seek(0)
+    try:
+        sample_rate = sf.info(audio_file).samplerate
+    except RuntimeError:
+        # Not a libsndfile format (e.g. AAC, or MP3 with older libsndfile versions)
+        sample_rate = None
+
+    if sample_rate == STT_SAMPLE_RATE:
+        audio_file.seek(0)
+        samples, _ = sf.read(audio_file, dtype="float32")
+        if samples.ndim > 1:
+            samples = samples.mean(axis=1)
+        return samples
+
+    # Everything else is decoded, downmixed and resampled by PyAV
+    audio_file.seek(0)
+    return decode_audio(audio_file, sampling_rate=STT_SAMPLE_RATE)
+
+
+def _extract_features(audios: list) -> np.ndarray:
+    """
+    Returns the (batch, n_mels, STT_CHUNK_FRAMES) log-Mel features of clips padded to 30 s.
+    On the GPU the whole batch goes through a single batched_log_mel() call.
+    """
+    audio_batch = np.stack([np.pad(audio, (0, STT_CHUNK_SAMPLES - len(audio))) for audio in audios])
+    if _hann is not None:
+        with _stt_stream_context():
+            features = batched_log_mel(torch.from_numpy(audio_batch).to(_hann.device)).cpu().numpy()
+    else:
+        features = np.stack([stt_model.feature_extractor(audio) for audio in audio_batch])
+    return np.ascontiguousarray(features[..., :STT_CHUNK_FRAMES])
+
+
+def _trim_silence(audio: np.ndarray, speech_timestamps: list) -> np.ndarray:
+    """
+    Keeps only the voiced regions found by Silero VAD (get_speech_timestamps), concatenated in order.
+    Returns an empty array for audio without speech.
+    """
+    if not speech_timestamps:
+        return audio[:0]
+    return np.concatenate([audio[ts["start"]:ts["end"]] for ts in speech_timestamps])
+
+
+def _transcribe_long(audio: np.ndarray, speech_timestamps: list = None) -> str:
+    """
+    Transcribes an audio of any length with the batched pipeline (VAD + 30 s chunks).
+    Speech timestamps already computed with STT_VAD_OPTIONS are reused instead of running the VAD again.
+    """
+    if speech_timestamps:
+        # merge_segments() adjusts the timestamps in place
+        clip_timestamps = merge_segments([dict(ts) for ts in speech_timestamps], STT_VAD_OPTIONS)
+        segments, info = batched_model.transcribe(audio, batch_size=STT_MAX_BATCH, beam_size=1,
+                                                  vad_filter=False, clip_timestamps=clip_timestamps)
+    else:
+        segments, info = batched_model.transcribe(audio, batch_size=STT_MAX_BATCH, beam_size=1)
+    logger.debug(f"Transcription info: {info}")
+    # segments is a generator: decoding runs while the texts are joined
+    return "".join(segment.text for segment in segments)
+
+
+def _transcribe_with_fallback(audio: np.ndarray) -> str:
+    """
+    Transcribes a voiced clip with faster-whisper's sequential decoder, which retries each window at
+    the next of STT_FALLBACK_TEMPERATURES while its output fails the log probability or compression checks.
+    The batched pipeline cannot be used for this: it decodes once at temperature 0.
+    """
+    segments, _ = stt_model.transcribe(audio, beam_size=1, vad_filter=False, temperature=STT_FALLBACK_TEMPERATURES,
+                                       log_prob_threshold=STT_LOG_PROB_THRESHOLD,
+                                       compression_ratio_threshold=STT_COMPRESSION_RATIO_THRESHOLD,
+                                       no_speech_threshold=STT_NO_SPEECH_THRESHOLD)
+    return "".join(segment.text for segment in segments)
+
+
+def _transcribe_short_clips(audios: list) -> list:
+    """
+    Transcribes clips of at most 30 s from several requests at once.
+    The encoder runs once over the whole batch and CTranslate2 decodes all clips in one
+    greedy generate() call, reusing the encoder output and the decoder KV cache at every step.
+    Clips whose output fails the log probability or compression checks are retried with temperature fallback.
+    """
+    encoder_output = stt_model.encode(_extract_features(audios))
+    results = stt_model.model.generate(
+        encoder_output,
+        [_stt_prompt] * len(audios),
+        beam_size=1,
+        max_length=stt_model.max_length,
+        return_scores=True,
+        return_no_speech_prob=True,
+        suppress_blank=True,
+        suppress_tokens=[-1],
+    )
+
+    texts = []
+    for audio, result in zip(audios, results):
+        tokens = result.sequences_ids[0]
+        # CTranslate2 scores are normalized by length; recover the average log probability
+        avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+        if result.no_speech_prob > STT_NO_SPEECH_THRESHOLD and avg_logprob < STT_LOG_PROB_THRESHOLD:
+            texts.append("")
+            continue
+        text = _stt_tokenizer.decode(tokens)
+        if avg_logprob < STT_LOG_PROB_THRESHOLD or get_compression_ratio(text) > STT_COMPRESSION_RATIO_THRESHOLD:
+            # Low confidence or repetition loop: the greedy pass is retried at increasing temperatures
+            logger.debug("Short-clip transcription failed the quality checks, retrying with temperature fallback.")
+            text = _transcribe_with_fallback(audio)
+        texts.append(text)
+    return texts
+
+
+def _transcribe_batch(audio_files: list) -> list:
+    """
+    Decodes and transcribes a batch of uploaded audio files. Runs in a worker thread.
+    Silence is trimmed with VAD first: audios with at most 30 s of speech are transcribed together,
+    longer ones go through the batched pipeline one by one.
+    Returns one transcription text (or the raised exception) per input.
+    """
+    results = [None] * len(audio_files)
+    short_indices, short_audios = [], []
+    for index, audio_file in enumerate(audio_files):
+        try:
+            audio = _decode_audio_file(audio_file)
+            speech_timestamps = get_speech_timestamps(audio, STT_VAD_OPTIONS)
+            voiced_audio = _trim_silence(audio, speech_timestamps)
+            if len(voiced_audio) == 0:
+                # Nothing to transcribe, whisper would only hallucinate on silence
+                results[index] = ""
+            elif len(voiced_audio) <= STT_CHUNK_SAMPLES:
+                short_indices.append(index)
+                short_audios.append(voiced_audio)
+            else:
+                # The pipeline splits the speech into 30 s chunks, reusing the VAD output
+                results[index] = _transcribe_long(audio, speech_timestamps)
+        except Exception as e:
+            results[index] = e
+
+    if short_audios:
+        try:
+            texts = _transcribe_short_clips(short_audios)
+        except Exception as e:
+            texts = [e] * len(short_audios)
+        for index, text in zip(short_indices, texts):
+            results[index] = text
+    return results
+
+
+async def batch_worker():
+    """
+    Background task draining stt_queue.
+    Waits for a request, then collects up to STT_MAX_BATCH requests arriving within
+    STT_MAX_WAIT_MS and transcribes them in one STT_POOL call, resolving each request's future.
+    """
+    loop = asyncio.get_running_loop()
+    logger.info("STT batch worker started.")
+    while True:
+        batch = [await stt_queue.get()]
+        deadline = loop.time() + STT_MAX_WAIT_MS / 1000
+        while len(batch) < STT_MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(stt_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Skip requests whose caller has already gone away
+        batch = [(audio_file, future) for audio_file, future in batch if not future.done()]
+        if not batch:
+            continue
+
+        logger.info(f"Transcribing STT batch of {len(batch)} request(s)...")
+        try:
+            results = await loop.run_in_executor(STT_POOL, _transcribe_batch, [audio_file for audio_file, _ in batch])
+        except Exception as e:
+            logger.error(f"STT batch failed: {e}", exc_info=True)
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+# Streaming (WebSocket) transcription settings
+STT_STREAM_ROUND_SECONDS = 0.5    # New audio needed before the buffer is transcribed again
+STT_STREAM_MAX_BUFFER_SECONDS = 15  # Unconfirmed audio kept before words are confirmed anyway
+STT_STREAM_PROMPT_CHARS = 200     # Confirmed text passed back to the model as context
+
+
+def _normalize_word(word: str) -> str:
+    """
+    Normalizes a word for comparison between two transcription rounds.
+    """
+    return word.strip().lower().strip(".,!?;:\"'")
+
+
+class LocalAgreementTranscriber:
+    """
+    Incremental transcription of a live audio stream using the LocalAgreement-2 policy.
+    The unconfirmed audio buffer is transcribed again every STT_STREAM_ROUND_SECONDS of new audio,
+    and words are confirmed once two consecutive rounds agree on them. Audio up to the last
+    confirmed word is then dropped, so each round only processes the unconfirmed tail.
+    """
+
+    def __init__(self):
+        self.audio_buffer = np.zeros(0, dtype=np.float32)
+        self.new_samples = 0
+        # Unconfirmed (start, end, text) words of the previous round, relative to audio_buffer
+        self.previous_words = []
+        self.confirmed_text = ""
+        # Trailing byte of a frame that ended in the middle of a sample
+        self._partial_sample = b""
+
+    def insert_audio(self, pcm_bytes: bytes):
+        """
+        Appends 16 kHz mono 16-bit little-endian PCM samples to the buffer.
+        Frames do not have to end on a sample boundary: an odd trailing byte is kept for the next frame.
+        """
+        if self._partial_sample:
+            pcm_bytes = self._partial_sample + pcm_bytes
+        sample_count = len(pcm_bytes) // 2
+        self._partial_sample = pcm_bytes[2 * sample_count:]
+        samples = np.frombuffer(pcm_bytes, dtype='<i2', count=sample_count).astype(np.float32) / 32768.0
+        self.audio_buffer = np.concatenate([self.audio_buffer, samples])
+        self.new_samples += len(samples)
+
+    def ready(self) -> bool:
+        """
+        Whether enough new audio arrived for another transcription round.
+        """
+        return self.new_samples >= STT_STREAM_ROUND_SECONDS * STT_SAMPLE_RATE
+
+    def _transcribe_words(self) -> list:
+        # Every round re-reads the whole unconfirmed buffer, so the model must not be conditioned on its
+        # own previous output; the confirmed text is only passed as a prompt for context.
+        segments, _ = stt_model.transcribe(
+            self.audio_buffer,
+            beam_size=1,
+            vad_filter=True,
+            word_timestamps=True,
+            condition_on_previous_text=False,
+            initial_prompt=self.confirmed_text[-STT_STREAM_PROMPT_CHARS:] or None,
+        )
+        return [(word.start, word.end, word.word) for segment in segments for word in segment.words]
+
+    def _confirm(self, words: list) -> str:
+        text = "".join(word for _, _, word in words)
+        self.confirmed_text += text
+        # Drop the audio of the confirmed words from the buffer
+        self.audio_buffer = self.audio_buffer[int(words[-1][1] * STT_SAMPLE_RATE):]
+        return text
+
+    def _process_round(self) -> str:
+        self.new_samples = 0
+        words = self._transcribe_words()
+
+        agreed = 0
+        for previous, current in zip(self.previous_words, words):
+            if _normalize_word(previous[2]) != _normalize_word(current[2]):
+                break
+            agreed += 1
+
+        buffer_seconds = len(self.audio_buffer) / STT_SAMPLE_RATE
+        if buffer_seconds > STT_STREAM_MAX_BUFFER_SECONDS and words:
+            # No agreement for too long: confirm all but the last (possibly cut) word,
+            # or that word itself if it is the only one, so that the buffer always shrinks
+            agreed = max(agreed, len(words) - 1, 1)
+        if not words and buffer_seconds > STT_STREAM_MAX_BUFFER_SECONDS:
+            # Long stretch without speech: keep only the most recent audio
+            self.audio_buffer = self.audio_buffer[-int(STT_STREAM_ROUND_SECONDS * STT_SAMPLE_RATE):]
+
+        self.previous_words = words[agreed:]
+        if not agreed:
+            return ""
+        confirmed_end = words[agreed - 1][1]
+        self.previous_words = [(start - confirmed_end, end - confirmed_end, word) for start, end, word in self.previous_words]
+        return self._confirm(words[:agreed])
+
+    def _finish(self) -> str:
+        words = self._transcribe_words() if len(self.audio_buffer) else []
+        self.previous_words = []
+        if not words:
+            return ""
+        return self._confirm(words)
+
+    async def process(self) -> str:
+        """
+        Runs one transcription round in STT_POOL and returns the newly confirmed text (possibly empty).
+        """
+        return await asyncio.get_running_loop().run_in_executor(STT_POOL, self._process_round)
+
+    async def finish(self) -> str:
+        """
+        Transcribes the remaining buffer in STT_POOL and returns its text, confirming everything.
+        """
+        return await asyncio.get_running_loop().run_in_executor(STT_POOL, self._finish)
+
+
+async def warmup_stt():
+    """
+    Runs one second of silence through Silero VAD and the short-clip path so that the VAD model,
+    CTranslate2 kernels and the GPU feature extraction are initialized before the first real request.
+    """
+    if not stt_model:
+        return
+    start = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        silence = np.zeros(STT_SAMPLE_RATE, dtype=np.float32)
+        # Silence has no speech timestamps, so this only loads the VAD model
+        await loop.run_in_executor(STT_POOL, get_speech_timestamps, silence, STT_VAD_OPTIONS)
+        await loop.run_in_executor(STT_POOL, _transcribe_short_clips, [silence])
+        logger.info(f"STT warm-up finished in {time.perf_counter() - start:.2f} s.")
+    except Exception as e:
+        logger.error(f"STT warm-up failed after {time.perf_counter() - start:.2f} s: {e}", exc_info=True)
 
 
 async def transcribe_audio_file(audio_file: UploadFile) -> str:
@@ -44,31 +561,20 @@ async def transcribe_audio_file(audio_file: UploadFile) -> str:
 
     logger.info(f"Preparing to transcribe audio file: {audio_file.filename}")
     
-    # Save UploadFile to a temporary file because whisper.transcribe() expects a file path.
-    # Using mkstemp for a secure temporary file.
-    fd, tmp_path = tempfile.mkstemp()
-    logger.debug(f"Temporary file created for STT: {tmp_path}")
-
     try:
-        with os.fdopen(fd, 'wb') as tmp_file_obj:
-            shutil.copyfileobj(audio_file.file, tmp_file_obj)
-        logger.debug(f"Audio content copied to temporary file: {tmp_path}")
-
-        # Transcribe
-        # For CPU, fp16=False is important. If GPU, fp16=True can be used if supported.
-        logger.info(f"Starting transcription with Whisper model ({stt_model_name}) on {device}...")
-        result = stt_model.transcribe(tmp_path, fp16=(device == "cuda" and torch.cuda.is_available()))
-        transcription = result["text"]
+        # Hand the upload's spooled file (in memory, or on disk for large uploads) over to the batch
+        # worker, which decodes it in place in STT_POOL. Nothing is read on the event loop and the
+        # upload is never copied into an intermediate bytes object or temporary file.
+        # The batched pipeline uses greedy decoding (beam_size=1) and VAD to skip silent regions.
+        logger.info(f"Queueing transcription with Whisper model ({stt_model_name}) on {device}...")
+        future = asyncio.get_running_loop().create_future()
+        await stt_queue.put((audio_file.file, future))
+        transcription = await future
         logger.info("Transcription successful.")
-        logger.debug(f"Raw transcription result: {result}")
     except Exception as e:
         logger.error(f"Error during audio transcription: {e}", exc_info=True)
         raise RuntimeError(f"Failed to transcribe audio: {e}")
     finally:
-        # Clean up the temporary file
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-            logger.debug(f"Temporary file {tmp_path} removed.")
         # Ensure the uploaded file stream is closed
         await audio_file.close()
         logger.debug(f"Uploaded file stream {audio_file.filename} closed.")
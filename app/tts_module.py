@@ -2,8 +2,15 @@
 # Module for Text-to-Speech using Coqui TTS
 
 from TTS.api import TTS as CoquiTTS
-import soundfile as sf
-import io
+import asyncio
+import concurrent.futures
+import contextlib
+from collections import OrderedDict
+import hashlib
+import os
+import struct
+import time
+import numpy as np
 import torch
 import logging
 
@@ -11,58 +18,326 @@ logger = logging.getLogger(__name__)
 
 # Determine device (CPU for broader compatibility in local Docker testing)
 # If you have a CUDA-enabled Docker setup, this could be "cuda"
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# TTS always uses the first GPU; with several GPUs, STT takes the second one.
+device = "cuda:0" if torch.cuda.is_available() else "cpu"
 logger.info(f"TTS module will use device: {device}")
 
 # Load TTS model
 # This will download the model on first run if not already present in the expected cache path.
-# The Dockerfile aims to pre-download this.
+# The Dockerfile aims to pre-download this. Loading happens in get_tts_model(), called at application startup.
 tts_model_name = "tts_models/en/ljspeech/vits" # A good quality English VITS model
 tts_model = None
+# Fallback for common LJSpeech VITS sample rate if the model does not report one
+DEFAULT_SAMPLE_RATE = 22050
+# Output sample rate of the loaded model, resolved once at load time
+TTS_SAMPLE_RATE = DEFAULT_SAMPLE_RATE
+# Uncompiled VITS inference method, kept to fall back to if torch.compile fails
+_eager_inference = None
+# CUDA stream for TTS inference so that it can overlap with STT work, created at load time
+TTS_STREAM = None
 
-try:
-    logger.info(f"Loading Coqui TTS model: {tts_model_name}...")
-    # progress_bar=False to prevent issues in non-interactive environments like Docker build
-    tts_model = CoquiTTS(model_name=tts_model_name, progress_bar=False).to(device)
-    logger.info(f"Coqui TTS model '{tts_model_name}' loaded successfully on {device}.")
-except Exception as e:
-    logger.error(f"Error loading Coqui TTS model '{tts_model_name}': {e}", exc_info=True)
-    tts_model = None # Ensure model is None if loading fails
+# Cache of synthesized sentences (16-bit PCM bytes), keyed by a hash of (model, sample rate, text).
+# Recently used sentences are kept in memory; sentences are also persisted to disk, where the least
+# recently used files are evicted once the cache exceeds TTS_DISK_CACHE_MAX_MB (0 disables the disk tier).
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_HOME", "/app/cache/tts")
+TTS_CACHE_MAX_ENTRIES = 512
+TTS_DISK_CACHE_MAX_BYTES = int(os.getenv("TTS_DISK_CACHE_MAX_MB", "512")) * 1024 * 1024
+_tts_cache = OrderedDict()
+_tts_cache_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "cache_bytes": 0, "disk_evictions": 0}
+_tts_disk_cache_enabled = False
+# Size of the disk cache: measured at startup and on eviction, plus what this process wrote since
+_tts_disk_cache_bytes = 0
 
-def synthesize_speech_to_bytes(text_input: str) -> bytes:
+# Blocking synthesis runs here instead of on the event loop.
+# A single worker serializes access to the model (and the GPU).
+TTS_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts")
+
+def _resolve_sample_rate(model) -> int:
+    """
+    Returns the output sample rate of a loaded TTS model.
+    """
+    sample_rate = 0
+    if hasattr(model, 'synthesizer') and hasattr(model.synthesizer, 'output_sample_rate'):
+        sample_rate = model.synthesizer.output_sample_rate
+    elif hasattr(model, 'config') and 'audio' in model.config and 'sample_rate' in model.config.audio:
+        sample_rate = model.config.audio['sample_rate']
+
+    if not sample_rate:
+        logger.warning(f"Could not reliably determine sample rate from model. Defaulting to {DEFAULT_SAMPLE_RATE} Hz.")
+        return DEFAULT_SAMPLE_RATE
+    return sample_rate
+
+def get_tts_model():
+    """
+    Returns the Coqui TTS model, loading it into the module globals on first use.
+    Returns None if loading failed. On CPU it may be loaded in the Gunicorn master before
+    the workers fork (see gunicorn.conf.py); a CUDA model must be loaded in each worker.
+    Callers running several processes should hold the model directory lock (see main.py).
+    """
+    global tts_model, TTS_SAMPLE_RATE, _eager_inference, TTS_STREAM
+    if tts_model is not None:
+        return tts_model
+
+    try:
+        logger.info(f"Loading Coqui TTS model: {tts_model_name}...")
+        # progress_bar=False to prevent issues in non-interactive environments like Docker build
+        model = CoquiTTS(model_name=tts_model_name, progress_bar=False).to(device)
+        if device.startswith("cuda"):
+            TTS_STREAM = torch.cuda.Stream(device=device)
+            # The weights were moved on the default stream
+            torch.cuda.synchronize(device)
+            # Coqui's synthesizer calls the VITS model's inference() method rather than forward(),
+            # so that is what gets compiled. Compilation itself happens lazily on the first call.
+            # CUDA only: TorchInductor needs a C++ toolchain on CPU, which the image does not ship.
+            # The input length changes with every sentence, so the graph is compiled with dynamic shapes
+            # and without CUDA graphs ("default" mode): "reduce-overhead" would recompile and record
+            # a new CUDA graph (with its own memory pool) for every distinct sentence length.
+            vits = model.synthesizer.tts_model
+            _eager_inference = vits.inference
+            vits.inference = torch.compile(_eager_inference, mode="default", dynamic=True, fullgraph=False)
+            logger.info("Coqui TTS model inference compiled with torch.compile (dynamic shapes).")
+        TTS_SAMPLE_RATE = _resolve_sample_rate(model)
+        # Published last so that the model is never visible half-initialized
+        tts_model = model
+        logger.info(f"Coqui TTS model '{tts_model_name}' loaded successfully on {device} ({TTS_SAMPLE_RATE} Hz).")
+    except Exception as e:
+        logger.error(f"Error loading Coqui TTS model '{tts_model_name}': {e}", exc_info=True)
+        tts_model = None # Ensure model is None if loading fails
+    return tts_model
+
+def _scan_disk_cache() -> list:
+    """
+    Returns (mtime, size, path) for every file of the TTS disk cache.
+    """
+    entries = []
+    with os.scandir(TTS_CACHE_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(".pcm"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue # Evicted by another worker meanwhile
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+if TTS_DISK_CACHE_MAX_BYTES > 0:
+    try:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        _tts_disk_cache_enabled = os.access(TTS_CACHE_DIR, os.W_OK)
+        _tts_disk_cache_bytes = sum(size for _, size, _ in _scan_disk_cache())
+    except OSError as e:
+        logger.warning(f"TTS disk cache disabled, could not create {TTS_CACHE_DIR}: {e}")
+        _tts_disk_cache_enabled = False
+
+# Size written to the RIFF and data fields of streamed WAV files, whose final length is unknown
+WAV_STREAM_DATA_SIZE = 0xFFFFFFFF
+
+def _tts_inference_context():
+    """
+    Returns a context manager for running TTS inference: inference mode (no autograd
+    bookkeeping) and, on CUDA, the dedicated TTS_STREAM.
+    """
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if TTS_STREAM is not None:
+        stack.enter_context(torch.cuda.stream(TTS_STREAM))
+    return stack
+
+def _wav_header(sample_rate: int, data_size: int) -> bytes:
+    """
+    Builds the 44-byte header of a mono 16-bit PCM WAV file.
+    """
+    riff_size = min(36 + data_size, 0xFFFFFFFF)
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', riff_size, b'WAVE',
+                       b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+                       b'data', data_size)
+
+def _to_pcm16(waveform) -> bytes:
+    """
+    Converts a float waveform in [-1, 1] to little-endian 16-bit PCM bytes.
     """
-    Synthesizes speech from text input and returns WAV audio bytes.
+    samples = np.asarray(waveform, dtype=np.float32)
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+def _synthesize_sentence_pcm(sentence: str) -> bytes:
+    """
+    Synthesizes a single sentence and returns it as little-endian 16-bit PCM samples.
+    """
+    # Coqui appends a short pause after each sentence, so chunks can be concatenated as-is.
+    with _tts_inference_context():
+        waveform = tts_model.tts(text=sentence, speaker=None, language=None, split_sentences=False)
+        if TTS_STREAM is not None:
+            TTS_STREAM.synchronize()
+    return _to_pcm16(waveform)
+
+def _read_disk_cache(cache_path: str):
+    """
+    Returns the PCM bytes cached in cache_path, or None if there are none.
+    A hit refreshes the file's modification time, which orders the LRU eviction.
+    """
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            pcm = cache_file.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning(f"Could not read TTS cache file {cache_path}: {e}")
+        return None
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass # Evicted by another worker meanwhile; the bytes read are still valid
+    return pcm
+
+def _write_disk_cache(cache_path: str, pcm: bytes):
+    """
+    Persists the PCM bytes of a sentence, evicting old files if the disk cache grows past its budget.
+    """
+    global _tts_disk_cache_bytes
+    try:
+        # Write to a temporary name first so that other workers never read a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(pcm)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"Could not write TTS cache file {cache_path}: {e}")
+        return
+    _tts_disk_cache_bytes += len(pcm)
+    if _tts_disk_cache_bytes > TTS_DISK_CACHE_MAX_BYTES:
+        _evict_disk_cache()
+
+def _evict_disk_cache():
+    """
+    Deletes the least recently used cache files until the disk cache is below 90% of its budget.
+    The directory is rescanned first, so that files written by other workers are accounted for.
+    """
+    global _tts_disk_cache_bytes
+    entries = sorted(_scan_disk_cache())
+    total = sum(size for _, size, _ in entries)
+    target = TTS_DISK_CACHE_MAX_BYTES * 0.9
+    evicted = 0
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            evicted += 1
+        except FileNotFoundError:
+            pass # Already evicted by another worker
+        except OSError as e:
+            logger.warning(f"Could not evict TTS cache file {path}: {e}")
+            continue
+        total -= size
+    _tts_disk_cache_bytes = total
+    _tts_cache_stats["disk_evictions"] += evicted
+    logger.info(f"TTS disk cache: evicted {evicted} file(s), {total / (1024 * 1024):.1f} MB left.")
+
+def _cached_sentence_pcm(sentence: str) -> bytes:
+    """
+    Returns the PCM bytes of a sentence from the memory or disk cache, synthesizing it on a miss.
+    Only called from TTS_POOL, so the cache needs no locking.
+    """
+    key = hashlib.blake2b(f"{tts_model_name}|{TTS_SAMPLE_RATE}|{sentence}".encode(), digest_size=16).hexdigest()
+
+    pcm = _tts_cache.get(key)
+    if pcm is not None:
+        _tts_cache.move_to_end(key)
+        _tts_cache_stats["memory_hits"] += 1
+        return pcm
+
+    cache_path = os.path.join(TTS_CACHE_DIR, f"{key}.pcm")
+    pcm = _read_disk_cache(cache_path) if _tts_disk_cache_enabled else None
+    if pcm is not None:
+        _tts_cache_stats["disk_hits"] += 1
+    else:
+        pcm = _synthesize_sentence_pcm(sentence)
+        _tts_cache_stats["misses"] += 1
+        if _tts_disk_cache_enabled:
+            _write_disk_cache(cache_path, pcm)
+
+    _tts_cache[key] = pcm
+    _tts_cache_stats["cache_bytes"] += len(pcm)
+    if len(_tts_cache) > TTS_CACHE_MAX_ENTRIES:
+        _, evicted = _tts_cache.popitem(last=False)
+        _tts_cache_stats["cache_bytes"] -= len(evicted)
+    return pcm
+
+def get_tts_cache_stats() -> dict:
+    """
+    Returns TTS cache counters; cache_bytes is the size of the audio currently held in memory
+    and disk_cache_bytes the approximate size of the disk cache.
+    """
+    return {**_tts_cache_stats, "entries": len(_tts_cache), "disk_cache_enabled": _tts_disk_cache_enabled,
+            "disk_cache_bytes": _tts_disk_cache_bytes}
+
+async def synth_stream(text_input: str, use_cache: bool = True):
+    """
+    Synthesizes speech sentence by sentence and yields a streamable WAV file:
+    a header with an open-ended data size followed by one PCM chunk per sentence.
+    Synthesis runs in TTS_POOL so the event loop stays free between chunks.
+    Sentences already synthesized are served from the cache unless use_cache is False.
     """
     if not tts_model:
         logger.error("TTS synthesis failed: TTS model is not loaded.")
         raise RuntimeError("TTS model is not loaded. Please check logs for errors during startup.")
-    
-    logger.info(f"Synthesizing speech for text (first 50 chars): '{text_input[:50]}...'")
-    
+
+    logger.info(f"Streaming speech for text (first 50 chars): '{text_input[:50]}...'")
+    yield _wav_header(TTS_SAMPLE_RATE, WAV_STREAM_DATA_SIZE)
+
+    loop = asyncio.get_running_loop()
     try:
-        # The tts() method of TTS.api.TTS returns a list of floats (waveform)
-        waveform = tts_model.tts(text=text_input, speaker=None, language=None) # VITS model might not need speaker/language
-        
-        # Determine sample rate
-        sample_rate = 0
-        if hasattr(tts_model, 'synthesizer') and hasattr(tts_model.synthesizer, 'output_sample_rate'):
-            sample_rate = tts_model.synthesizer.output_sample_rate
-        elif hasattr(tts_model, 'config') and 'audio' in tts_model.config and 'sample_rate' in tts_model.config.audio:
-            sample_rate = tts_model.config.audio['sample_rate']
-        
-        if sample_rate == 0:
-            # Fallback for common LJSpeech VITS sample rate if not found
-            default_sr = 22050
-            logger.warning(f"Could not reliably determine sample rate from model. Defaulting to {default_sr} Hz.")
-            sample_rate = default_sr
-        else:
-            logger.info(f"Using sample rate: {sample_rate} Hz.")
-            
-        buffer = io.BytesIO()
-        sf.write(buffer, waveform, sample_rate, format='WAV', subtype='PCM_16')
-        buffer.seek(0)
-        logger.info("Speech synthesized and converted to WAV bytes successfully.")
-        return buffer.getvalue()
+        sentences = await loop.run_in_executor(TTS_POOL, tts_model.synthesizer.split_into_sentences, text_input)
+        for index, sentence in enumerate(sentences, start=1):
+            if use_cache:
+                yield await loop.run_in_executor(TTS_POOL, _cached_sentence_pcm, sentence)
+            else:
+                yield await loop.run_in_executor(TTS_POOL, _synthesize_sentence_pcm, sentence)
+            logger.debug(f"Streamed sentence {index}/{len(sentences)}.")
+        logger.info(f"Speech streamed successfully ({len(sentences)} sentence(s)).")
     except Exception as e:
-        logger.error(f"Error during speech synthesis: {e}", exc_info=True)
-        raise RuntimeError(f"Failed to synthesize speech: {e}")
\ No newline at end of file
+        logger.error(f"Error during streaming speech synthesis: {e}", exc_info=True)
+        raise RuntimeError(f"Failed to synthesize speech: {e}")
+
+# Representative sentence for the warm-up: punctuation, digits and common words exercise the
+# sentence splitter, text cleaners and phonemizer as well as the model itself
+WARMUP_TEXT = "Hello, this is warm-up pass number 1 of the speech service."
+
+async def _run_warmup_synthesis():
+    """
+    Synthesizes WARMUP_TEXT through synth_stream().
+    """
+    # Consume the stream so that the same code path as the /tts/ endpoint gets traced.
+    # The cache is bypassed, otherwise a cached phrase would skip the model entirely.
+    async for _ in synth_stream(WARMUP_TEXT, use_cache=False):
+        pass
+
+async def warmup_tts():
+    """
+    Runs a dummy synthesis so that lazy initialization (phonemizer, CUDA kernels, torch.compile
+    tracing) happens before the first real request. The graph is compiled with dynamic shapes, so
+    this one compilation serves all sentence lengths. Falls back to eager inference if compilation fails.
+    """
+    if not tts_model:
+        return
+    start = time.perf_counter()
+    try:
+        await _run_warmup_synthesis()
+        logger.info(f"TTS warm-up finished in {time.perf_counter() - start:.2f} s.")
+        return
+    except RuntimeError as e:
+        if _eager_inference is None:
+            logger.error(f"TTS warm-up failed after {time.perf_counter() - start:.2f} s: {e}")
+            return
+        logger.warning(f"TTS warm-up failed with the compiled model after {time.perf_counter() - start:.2f} s, "
+                       f"falling back to eager inference: {e}")
+        tts_model.synthesizer.tts_model.inference = _eager_inference
+
+    start = time.perf_counter()
+    try:
+        await _run_warmup_synthesis()
+        logger.info(f"TTS warm-up (eager) finished in {time.perf_counter() - start:.2f} s.")
+    except RuntimeError as e:
+        logger.error(f"TTS warm-up (eager) failed after {time.perf_counter() - start:.2f} s: {e}")
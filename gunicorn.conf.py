@@ -0,0 +1,38 @@
+# gunicorn.conf.py
+# Gunicorn configuration for serving the FastAPI app with Uvicorn workers
+
+import os
+
+# With preload_app the master imports the app, which checks for GPUs at import time.
+# By default torch.cuda.is_available()/device_count() initialize the CUDA runtime, which is
+# not fork-safe; the NVML-based check answers without it, so nothing touches CUDA before the fork.
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Each worker runs its own event loop (uvloop + httptools, installed via uvicorn[standard])
+# and loads its own copy of the models. Keep a single worker per GPU: every worker creates
+# its own CUDA context and the batching queues are per process.
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_WORKERS", "2"))
+
+# Import the app (torch, CTranslate2, Coqui TTS and their dependencies) once in the master,
+# so that workers share those pages copy-on-write instead of each importing them again.
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master before any worker is forked. A CPU Coqui model only holds torch CPU
+    # tensors, which are fork-safe, so it is loaded once here and the workers share its weights
+    # copy-on-write. CUDA models and the CTranslate2 Whisper model are still loaded by each worker
+    # at application startup: CUDA contexts and CTranslate2's worker threads do not survive fork().
+    from app import tts_module
+    if tts_module.device == "cpu":
+        server.log.info("Preloading the CPU TTS model in the master process.")
+        tts_module.get_tts_model()
+
+# Model loading and the startup warm-up (including torch.compile) can take minutes
+# on a cold container, well beyond gunicorn's default 30 s worker timeout.
+timeout = int(os.getenv("WEB_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive = 5
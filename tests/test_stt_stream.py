@@ -0,0 +1,93 @@
+# tests/test_stt_stream.py
+# Tests for the LocalAgreement-2 buffer logic of the /stt/stream endpoint.
+# Transcription itself is replaced by canned (start, end, text) word lists.
+
+import numpy as np
+import pytest
+
+from app.stt_module import LocalAgreementTranscriber, STT_SAMPLE_RATE, STT_STREAM_MAX_BUFFER_SECONDS
+
+
+def _transcriber(seconds: float, rounds: list) -> LocalAgreementTranscriber:
+    """
+    Returns a transcriber holding `seconds` of audio whose transcription rounds return `rounds` in order.
+    """
+    transcriber = LocalAgreementTranscriber()
+    transcriber.insert_audio(np.zeros(int(seconds * STT_SAMPLE_RATE), dtype='<i2').tobytes())
+    results = iter(rounds)
+    transcriber._transcribe_words = lambda: next(results)
+    return transcriber
+
+
+def test_words_are_confirmed_once_two_rounds_agree():
+    transcriber = _transcriber(3.0, [
+        [(0.0, 0.5, " Hello"), (0.6, 1.0, " world"), (1.1, 1.5, " this")],
+        [(0.0, 0.5, " Hello"), (0.6, 1.0, " world,"), (1.1, 1.6, " is")],
+    ])
+
+    assert transcriber._process_round() == ""
+    assert transcriber.confirmed_text == ""
+    # "world" and "world," only differ by punctuation and still agree
+    assert transcriber._process_round() == " Hello world,"
+    assert transcriber.confirmed_text == " Hello world,"
+
+
+def test_confirmed_audio_is_trimmed_and_pending_words_are_rebased():
+    transcriber = _transcriber(3.0, [
+        [(0.0, 0.5, " Hello"), (0.6, 1.0, " there")],
+        [(0.0, 0.5, " Hello"), (0.6, 1.0, " world"), (1.2, 1.8, " again")],
+    ])
+
+    transcriber._process_round()
+    transcriber._process_round()
+
+    # Audio up to the end of the last confirmed word (" Hello", 0.5 s) is dropped
+    assert len(transcriber.audio_buffer) == int(2.5 * STT_SAMPLE_RATE)
+    # and the unconfirmed words are now relative to the trimmed buffer
+    starts, ends, words = zip(*transcriber.previous_words)
+    assert starts == pytest.approx((0.1, 0.7))
+    assert ends == pytest.approx((0.5, 1.3))
+    assert words == (" world", " again")
+
+
+def test_all_but_the_last_word_is_confirmed_past_the_buffer_limit():
+    seconds = STT_STREAM_MAX_BUFFER_SECONDS + 1
+    transcriber = _transcriber(seconds, [
+        [(0.0, 0.5, " One"), (0.6, 1.0, " two"), (1.1, 1.5, " three")],
+    ])
+
+    # No previous round to agree with, but the buffer is over the limit
+    assert transcriber._process_round() == " One two"
+    assert [word for _, _, word in transcriber.previous_words] == [" three"]
+    assert len(transcriber.audio_buffer) == int((seconds - 1.0) * STT_SAMPLE_RATE)
+
+
+def test_a_single_word_is_confirmed_past_the_buffer_limit():
+    seconds = STT_STREAM_MAX_BUFFER_SECONDS + 1
+    transcriber = _transcriber(seconds, [
+        [(0.0, 2.0, " Music")],
+    ])
+
+    assert transcriber._process_round() == " Music"
+    assert transcriber.previous_words == []
+    assert len(transcriber.audio_buffer) == int((seconds - 2.0) * STT_SAMPLE_RATE)
+
+
+def test_finish_confirms_the_remaining_words():
+    transcriber = _transcriber(2.0, [
+        [(0.0, 0.5, " Hello"), (0.6, 1.0, " world")],
+    ])
+
+    assert transcriber._finish() == " Hello world"
+    assert transcriber.previous_words == []
+
+
+def test_frames_may_split_a_sample():
+    transcriber = LocalAgreementTranscriber()
+    pcm = np.array([1000, -2000, 3000], dtype='<i2').tobytes()
+
+    transcriber.insert_audio(pcm[:3])
+    transcriber.insert_audio(pcm[3:])
+
+    np.testing.assert_allclose(transcriber.audio_buffer * 32768.0, [1000, -2000, 3000])
+    assert transcriber.new_samples == 3